@@ -1,13 +1,17 @@
-import json
 import os
-import time
 import asyncio
 from datetime import datetime
 import logging
 import sys
 import re
-from bs4 import BeautifulSoup
-from playwright.async_api import async_playwright
+import importlib.util
+from urllib.parse import urlsplit
+from collections import defaultdict
+from functools import lru_cache
+import orjson
+from bs4 import BeautifulSoup, SoupStrainer
+from jinja2 import Environment, FileSystemLoader
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 
 # Configurazione del logging
 logging.basicConfig(
@@ -21,59 +25,195 @@ logger = logging.getLogger(__name__)
 CONFIG_FILE = 'config.json'
 DATA_DIR = 'data'
 HISTORY_FILE = f"{DATA_DIR}/documents_history.json"
+TEMPLATES_DIR = 'templates'
+NOTIFICATION_TEMPLATE = 'notification.html.j2'
+
+# Pagina di ricerca del RUNTS
+SEARCH_URL = "https://servizi.lavoro.gov.it/runts/it-it/Ricerca-enti"
+
+# Selettori alternativi degli elementi della ricerca, valutati dal browser in una sola chiamata
+COOKIE_BUTTON_SELECTOR = "button:has-text('ACCETTA'), a.cookieClose, button.cookie-accept"
+CF_INPUT_SELECTOR = "#CodiceFiscale, #dnn_ctr446_View_txtCodiceFiscale, input[id*='CodiceFiscale']"
+SEARCH_BUTTON_SELECTOR = "button:has-text('CERCA'), #dnn_ctr446_View_btnRicercaEnti, input[value='CERCA']"
+DETAIL_BUTTON_SELECTOR = "a:has-text('DETTAGLIO'), input[value='Dettaglio'], .btn:has-text('Dettaglio')"
+
+# Endpoint CDP di un Chromium già avviato (opzionale): se impostato ci si collega invece di avviarne uno nuovo
+BROWSER_CDP_URL = os.environ.get("RUNTS_BROWSER_CDP_URL")
+
+# Numero massimo di enti elaborati in parallelo (un contesto browser per ente)
+MAX_CONCURRENT_ENTI = 4
+
+# Tipi di risorse che non servono all'estrazione e non vengono scaricate
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+
+# Domini di analytics e tracciamento di terze parti, mai necessari alla navigazione
+BLOCKED_HOST_RE = re.compile(r'google-analytics\.com|googletagmanager\.com|googletagservices\.com|doubleclick\.net|hotjar\.com|analytics')
+
+# Parser HTML di BeautifulSoup: lxml se installato, altrimenti quello della libreria standard
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+
+# Anno nel formato 20XX all'interno delle date dei documenti
+YEAR_RE = re.compile(r'20\d{2}')
+
+# Testo che identifica la sezione documenti nella pagina di dettaglio
+DOCUMENTS_SECTION_TEXT = "Atti e documenti"
+DOCUMENTS_SECTION_RE = re.compile(DOCUMENTS_SECTION_TEXT)
+SECTION_HEADING_TAGS = ('h1', 'h2', 'h3', 'h4')
+# Tabella che segue il titolo della sezione (il titolo deve essere un heading, non un link di
+# navigazione con lo stesso testo; :has-text accetta anche il testo annidato in uno span)
+DOCUMENTS_TABLE_SELECTOR = (
+    f":is({', '.join(SECTION_HEADING_TAGS)}):has-text('{DOCUMENTS_SECTION_TEXT}')"
+    " >> xpath=following::table[1]"
+)
+# Seconda riga della tabella (la prima è l'intestazione): c'è solo quando la tabella è stata popolata
+DOCUMENTS_TABLE_ROW_SELECTOR = f"{DOCUMENTS_TABLE_SELECTOR} >> xpath=(.//tr)[2]"
+# Attesa breve per le righe: gli enti senza documenti hanno la tabella ma nessuna riga di dati
+DOCUMENTS_ROWS_TIMEOUT = 3000
+DOCUMENT_HEADER_RE = re.compile('Documento|documento|Allegato')
+
+# Elementi della pagina di dettaglio da costruire nell'albero: head, script e stili vengono saltati.
+# I div racchiudono tutto il contenuto della pagina, quindi anche i testi di ripiego restano ricercabili
+DETAIL_STRAINER = SoupStrainer(['table', 'h1', 'h2', 'h3', 'h4', 'div'])
+
+# Parole chiave delle intestazioni: riconoscono una tabella documenti e ne mappano le colonne
+DOCUMENT_TABLE_RE = re.compile('documento|file|pratica|codice|allegato|data')
+COLUMN_PATTERNS = {
+    'documento': re.compile('documento|file|titolo'),
+    'codice': re.compile('codice|pratica|id'),
+    'data': re.compile('data|anno|period'),
+    'allegato': re.compile('allegato|download|file')
+}
+# Posizioni usate quando nessuna intestazione corrisponde
+COLUMN_DEFAULTS = {'documento': 0, 'codice': 1, 'data': 2, 'allegato': 3}
+
+# Ambiente dei template: compila ogni template una sola volta ed esegue l'escape dei valori
+TEMPLATE_ENV = Environment(
+    loader=FileSystemLoader(TEMPLATES_DIR),
+    autoescape=True,
+    trim_blocks=True,
+    lstrip_blocks=True
+)
 
 # Assicuriamoci che la directory data esista
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 
+# Playwright e browser condivisi tra più controlli nello stesso processo
+_playwright = None
+_browser = None
+
+async def get_browser():
+    """Restituisce il browser condiviso, avviandolo solo al primo utilizzo"""
+    global _playwright, _browser
+    if _browser is None or not _browser.is_connected():
+        if _playwright is None:
+            _playwright = await async_playwright().start()
+        if BROWSER_CDP_URL:
+            # Riusa un browser persistente: si risparmia l'avvio di Chromium a ogni esecuzione
+            _browser = await _playwright.chromium.connect_over_cdp(BROWSER_CDP_URL)
+            return _browser
+        # Usa un browser Chromium con impostazioni più permissive
+        _browser = await _playwright.chromium.launch(
+            headless=True,
+            args=[
+                '--disable-web-security', '--no-sandbox', '--disable-features=site-per-process',
+                # Niente immagini, GPU e servizi in background: serve solo il DOM
+                '--blink-settings=imagesEnabled=false', '--disable-gpu', '--disable-dev-shm-usage',
+                '--disable-background-networking', '--disable-default-apps', '--disable-extensions',
+                '--disable-sync'
+            ]
+        )
+    return _browser
+
+async def close_browser():
+    """Chiude il browser condiviso e arresta Playwright"""
+    # Con un browser collegato via CDP, close() si limita a disconnettersi
+    global _playwright, _browser
+    if _browser is not None:
+        await _browser.close()
+        _browser = None
+    if _playwright is not None:
+        await _playwright.stop()
+        _playwright = None
+
+async def block_heavy_resources(route):
+    """Blocca immagini, font, media, fogli di stile e analytics: serve solo l'HTML"""
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or BLOCKED_HOST_RE.search(urlsplit(request.url).netloc):
+        await route.abort()
+    else:
+        await route.continue_()
+
+@lru_cache(maxsize=1)
 def load_config():
-    """Carica la configurazione dal file config.json"""
-    with open(CONFIG_FILE, 'r') as f:
-        return json.load(f)
+    """Carica la configurazione dal file config.json (una sola volta per processo)"""
+    with open(CONFIG_FILE, 'rb') as f:
+        return orjson.loads(f.read())
 
 def load_history():
     """Carica lo storico dei documenti degli enti"""
     if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, 'r') as f:
-            return json.load(f)
+        with open(HISTORY_FILE, 'rb') as f:
+            return orjson.loads(f.read())
     return {}
 
+def write_json_atomic(path, data, option=None):
+    """Scrive un file JSON in modo atomico"""
+    # Scrive su un file temporaneo e lo sostituisce all'originale in un colpo solo,
+    # così un'interruzione durante la scrittura non lascia file troncati
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(orjson.dumps(data, option=option))
+        # Il contenuto deve essere su disco prima della sostituzione
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
 def save_history(history):
-    """Salva lo storico aggiornato"""
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
+    """Salva lo storico aggiornato in modo atomico"""
+    write_json_atomic(HISTORY_FILE, history, option=orjson.OPT_INDENT_2)
+
+def parse_html(content, parse_only=None):
+    """Costruisce l'albero BeautifulSoup con il parser scelto all'avvio"""
+    return BeautifulSoup(content, HTML_PARSER, parse_only=parse_only)
+
+def find_documents_section(soup):
+    """Individua la sezione "Atti e documenti" con una sola visita dell'albero"""
+    # Tutti i testi che contengono "Atti e documenti", in ordine di documento
+    matches = soup.find_all(string=DOCUMENTS_SECTION_RE)
+    
+    exact_heading = heading = div = None
+    for text in matches:
+        # Risale agli elementi di cui questo testo è l'unico contenuto
+        for tag in text.parents:
+            if tag.string is not text:
+                break
+            if tag.name in SECTION_HEADING_TAGS:
+                if exact_heading is None and text == DOCUMENTS_SECTION_TEXT:
+                    exact_heading = tag
+                if heading is None:
+                    heading = tag
+            elif tag.name == 'div' and div is None:
+                div = tag
+    
+    # Priorità: titolo esatto, titolo che lo contiene, div che lo contiene, qualsiasi testo
+    section = exact_heading or heading or div or (matches[0] if matches else None)
+    if section is not None:
+        return section
+    
+    # Ultima possibilità: una tabella con intestazioni tipiche di documenti
+    return soup.find(lambda tag: tag.name == 'table' and tag.find('th', string=DOCUMENT_HEADER_RE) is not None)
 
 def extract_documents(soup):
     """Estrae l'elenco dei documenti con particolare attenzione ai bilanci"""
     documents = []
+    # Coppie (tipo, codice) già inserite, per scartare i duplicati in tempo costante
+    seen_documents = set()
     try:
         # Cerca la sezione "Atti e documenti"
-        docs_section = None
-        
-        # Metodi multipli per trovare la sezione documenti
-        selectors = [
-            # Metodo 1: Cerca titoli che contengono esattamente "Atti e documenti"
-            lambda s: s.find(['h1', 'h2', 'h3', 'h4'], string="Atti e documenti"),
-            
-            # Metodo 2: Cerca titoli che contengono in qualche modo "Atti e documenti"
-            lambda s: s.find(['h1', 'h2', 'h3', 'h4'], string=lambda x: x and "Atti e documenti" in x),
-            
-            # Metodo 3: Cerca div con testo "Atti e documenti"
-            lambda s: s.find('div', string=lambda x: x and "Atti e documenti" in x),
-            
-            # Metodo 4: Cerca qualsiasi elemento con testo "Atti e documenti"
-            lambda s: s.find(string=lambda x: x and "Atti e documenti" in x),
-            
-            # Metodo 5: Cerca tabelle con intestazioni tipiche di documenti
-            lambda s: s.find('table', lambda t: t.find('th', string=lambda x: x and ("Documento" in x or "documento" in x or "Allegato" in x)))
-        ]
-        
-        # Prova ciascun selettore finché non troviamo una sezione
-        for selector in selectors:
-            docs_section = selector(soup)
-            if docs_section:
-                logger.info(f"Trovata sezione documenti")
-                break
+        docs_section = find_documents_section(soup)
+        if docs_section:
+            logger.info(f"Trovata sezione documenti")
         
         # Se abbiamo trovato una sezione testo (non una tabella), dobbiamo trovare la tabella associata
         tables = []
@@ -109,22 +249,30 @@ def extract_documents(soup):
             header_cells = rows[0].find_all(['th', 'td'])
             headers = [cell.get_text(strip=True).lower() for cell in header_cells]
             
-            # Verifica che questa sembri essere una tabella di documenti
-            if not any(keyword in ' '.join(headers) for keyword in 
-                      ['documento', 'file', 'pratica', 'codice', 'allegato', 'data']):
+            # In un solo passaggio sulle intestazioni verifica che sembri una tabella di documenti
+            # e mappa le colonne (vince la prima intestazione che corrisponde)
+            is_document_table = False
+            col_index = {}
+            for i, h in enumerate(headers):
+                if not is_document_table and DOCUMENT_TABLE_RE.search(h):
+                    is_document_table = True
+                for column, pattern in COLUMN_PATTERNS.items():
+                    if column not in col_index and pattern.search(h):
+                        col_index[column] = i
+            
+            if not is_document_table:
                 continue
             
-            # Mappa le colonne
-            col_index = {
-                'documento': next((i for i, h in enumerate(headers) if any(kw in h for kw in ['documento', 'file', 'titolo'])), 0),
-                'codice': next((i for i, h in enumerate(headers) if any(kw in h for kw in ['codice', 'pratica', 'id'])), 1),
-                'data': next((i for i, h in enumerate(headers) if any(kw in h for kw in ['data', 'anno', 'period'])), 2),
-                'allegato': next((i for i, h in enumerate(headers) if any(kw in h for kw in ['allegato', 'download', 'file'])), 3)
-            }
+            for column, default in COLUMN_DEFAULTS.items():
+                col_index.setdefault(column, default)
+            
+            # Le celle oltre l'ultima colonna utile non servono: ferma lì la ricerca in ogni riga
+            # (almeno due celle, per il controllo sulle righe troppo corte)
+            cells_limit = max(max(col_index.values()) + 1, 2)
             
             # Processa le righe (esclusa l'intestazione)
             for row in rows[1:]:
-                cells = row.find_all(['td', 'th'])
+                cells = row.find_all(['td', 'th'], limit=cells_limit)
                 if len(cells) < 2:  # Non abbastanza celle
                     continue
                 
@@ -142,7 +290,7 @@ def extract_documents(soup):
                     if col_index['data'] < len(cells) and cells[col_index['data']]:
                         date_text = cells[col_index['data']].get_text(strip=True)
                         # Cerca un anno in formato 20XX o date formattate
-                        year_match = re.search(r'20\d{2}', date_text)
+                        year_match = YEAR_RE.search(date_text)
                         if year_match:
                             date = year_match.group(0)
                         else:
@@ -153,7 +301,7 @@ def extract_documents(soup):
                         attachment_cell = cells[col_index['allegato']]
                         if (attachment_cell.find('a') or attachment_cell.find('img') or 
                             'download' in attachment_cell.get('class', []) or
-                            attachment_cell.find(lambda tag: tag.name == 'i' and 'download' in tag.get('class', []))):
+                            attachment_cell.find('i', class_='download')):
                             has_attachment = "Sì"
                     
                     # Se abbiamo almeno un tipo di documento o un codice pratica valido, aggiungilo
@@ -165,8 +313,9 @@ def extract_documents(soup):
                             "ha_allegato": has_attachment
                         }
                         # Evita documenti duplicati verificando se già esiste un doc con stesso tipo e codice
-                        if not any(d['tipo_documento'] == doc_type and d['codice_pratica'] == code 
-                                   for d in documents):
+                        document_key = (doc_type, code)
+                        if document_key not in seen_documents:
+                            seen_documents.add(document_key)
                             documents.append(document_data)
                 except Exception as e:
                     logger.error(f"Errore nell'estrazione dei dati del documento: {e}")
@@ -184,6 +333,29 @@ def extract_documents(soup):
     
     return documents
 
+def extract_documents_from_html(content):
+    """Estrae i documenti dall'HTML della pagina di dettaglio"""
+    # Analizza solo tabelle, titoli e div della pagina (questa è l'unica parte che ci interessa)
+    return extract_documents(parse_html(content, DETAIL_STRAINER))
+
+async def open_search_page(page):
+    """Apre la pagina di ricerca enti, riprovando una volta se il caricamento va in timeout"""
+    for attempt in range(2):
+        try:
+            # Basta il DOM: la rete può restare attiva a lungo per script di terze parti
+            await page.goto(SEARCH_URL, wait_until="domcontentloaded", timeout=30000)
+            break
+        except PlaywrightTimeoutError:
+            if attempt:
+                raise
+            logger.warning("Timeout nel caricamento della pagina di ricerca, nuovo tentativo")
+    
+    # Attendi il campo del codice fiscale prima di compilare il modulo
+    try:
+        await page.wait_for_selector(CF_INPUT_SELECTOR, state="attached", timeout=15000)
+    except PlaywrightTimeoutError:
+        logger.warning("Campo codice fiscale non trovato, provo comunque a compilare il modulo")
+
 async def extract_entity_documents(page, codice_fiscale, nome_ente):
     """Estrae solo i documenti di un ente (versione ottimizzata)"""
     logger.info(f"Ricerca documenti per l'ente {nome_ente} ({codice_fiscale})")
@@ -198,41 +370,33 @@ async def extract_entity_documents(page, codice_fiscale, nome_ente):
     
     try:
         # Naviga alla pagina di ricerca
-        await page.goto("https://servizi.lavoro.gov.it/runts/it-it/Ricerca-enti", wait_until="networkidle", timeout=30000)
-        
-        # Attendi che la pagina sia completamente caricata
-        await asyncio.sleep(2)
+        await open_search_page(page)
         
         # Gestione popup cookie se presente
         try:
-            # Prova diversi selettori per il pulsante dei cookie
-            for cookie_selector in ["button:has-text('ACCETTA')", "a.cookieClose", "button.cookie-accept"]:
-                cookie_button = await page.query_selector(cookie_selector)
-                if cookie_button:
-                    await cookie_button.click()
-                    break
+            cookie_button = page.locator(COOKIE_BUTTON_SELECTOR).first
+            if await cookie_button.count():
+                await cookie_button.click()
         except Exception:
             pass
         
         # Inserisci il codice fiscale nel campo appropriato
         filled = False
-        for selector in ["#CodiceFiscale", "#dnn_ctr446_View_txtCodiceFiscale", "input[id*='CodiceFiscale']"]:
-            try:
-                input_field = await page.query_selector(selector)
-                if input_field:
-                    await input_field.fill(codice_fiscale)
-                    filled = True
-                    break
-            except Exception:
-                continue
+        try:
+            input_field = page.locator(CF_INPUT_SELECTOR).first
+            if await input_field.count():
+                await input_field.fill(codice_fiscale)
+                filled = True
+        except Exception:
+            pass
         
         if not filled:
             # Prova un approccio più generico con JavaScript
             try:
-                await page.evaluate("""() => {
+                await page.evaluate("""cf => {
                     const inputs = Array.from(document.querySelectorAll('input'));
                     const cfInput = inputs.find(i => i.id && i.id.toLowerCase().includes('codice') && i.id.toLowerCase().includes('fiscale'));
-                    if (cfInput) cfInput.value = arguments[0];
+                    if (cfInput) cfInput.value = cf;
                 }""", codice_fiscale)
                 filled = True
             except Exception as e:
@@ -241,16 +405,13 @@ async def extract_entity_documents(page, codice_fiscale, nome_ente):
         
         # Clicca sul pulsante CERCA
         clicked = False
-        for selector in ["button:has-text('CERCA')", "#dnn_ctr446_View_btnRicercaEnti", "input[value='CERCA']", "button.btn-primary"]:
-            try:
-                search_button = await page.query_selector(selector)
-                if search_button:
-                    await search_button.click()
-                    clicked = True
-                    await page.wait_for_load_state("networkidle", timeout=15000)
-                    break
-            except Exception:
-                continue
+        try:
+            search_button = page.locator(SEARCH_BUTTON_SELECTOR).first
+            if await search_button.count():
+                await search_button.click()
+                clicked = True
+        except Exception:
+            pass
         
         if not clicked:
             try:
@@ -260,31 +421,35 @@ async def extract_entity_documents(page, codice_fiscale, nome_ente):
                     if (searchBtn) searchBtn.click();
                 }""")
                 clicked = True
-                await page.wait_for_load_state("networkidle", timeout=15000)
             except Exception as e:
                 logger.error(f"Errore nel cliccare il pulsante: {e}")
                 return entity_data
         
-        # Attendi che i risultati della ricerca siano caricati
-        await asyncio.sleep(3)
-        
-        # Verifica se ci sono risultati
-        page_content = await page.content()
-        if "Nessun risultato trovato" in page_content:
+        # Attendi che compaia il pulsante DETTAGLIO oppure il messaggio di nessun risultato
+        try:
+            await page.wait_for_selector(
+                f"{DETAIL_BUTTON_SELECTOR}, :text('Nessun risultato trovato')",
+                state="attached",
+                timeout=15000
+            )
+        except PlaywrightTimeoutError:
+            logger.warning(f"Risultati della ricerca non comparsi per {codice_fiscale}, procedo comunque")
+        
+        # Verifica se ci sono risultati (controllo eseguito nel browser, senza serializzare il DOM)
+        no_results = await page.evaluate("() => document.body.textContent.includes('Nessun risultato trovato')")
+        if no_results:
             logger.warning(f"Nessun risultato trovato per {codice_fiscale}")
             return entity_data
         
         # Clicca sul pulsante Dettaglio
         dettaglio_clicked = False
-        for selector in ["a:has-text('DETTAGLIO')", "input[value='Dettaglio']", ".btn:has-text('Dettaglio')"]:
-            try:
-                dettaglio_button = await page.query_selector(selector)
-                if dettaglio_button:
-                    await dettaglio_button.click()
-                    dettaglio_clicked = True
-                    break
-            except Exception:
-                continue
+        try:
+            dettaglio_button = page.locator(DETAIL_BUTTON_SELECTOR).first
+            if await dettaglio_button.count():
+                await dettaglio_button.click()
+                dettaglio_clicked = True
+        except Exception:
+            pass
         
         if not dettaglio_clicked:
             try:
@@ -298,16 +463,22 @@ async def extract_entity_documents(page, codice_fiscale, nome_ente):
                 logger.error(f"Errore nel cliccare DETTAGLIO: {e}")
                 return entity_data
         
-        # Aspetta che la pagina di dettaglio carichi
-        await page.wait_for_load_state("networkidle", timeout=20000)
-        await asyncio.sleep(5)
+        # Aspetta la tabella della sezione documenti invece di una pausa fissa,
+        # poi dà alle sue righe un breve margine per essere popolate
+        try:
+            await page.wait_for_selector(DOCUMENTS_TABLE_SELECTOR, state="attached", timeout=20000)
+            try:
+                await page.wait_for_selector(DOCUMENTS_TABLE_ROW_SELECTOR, state="attached", timeout=DOCUMENTS_ROWS_TIMEOUT)
+            except PlaywrightTimeoutError:
+                logger.info(f"Nessuna riga nella tabella '{DOCUMENTS_SECTION_TEXT}' per {nome_ente}")
+        except PlaywrightTimeoutError:
+            logger.warning(f"Tabella '{DOCUMENTS_SECTION_TEXT}' non comparsa per {nome_ente}, procedo comunque con l'estrazione")
         
         # Estrai solo i documenti dalla pagina (ottimizzazione)
         content = await page.content()
-        soup = BeautifulSoup(content, "html.parser")
         
-        # Estrai documenti (questa è l'unica parte che ci interessa)
-        entity_data["documenti"] = extract_documents(soup)
+        # L'analisi dell'HTML gira in un thread, così gli altri enti continuano a navigare
+        entity_data["documenti"] = await asyncio.to_thread(extract_documents_from_html, content)
         logger.info(f"Estratti {len(entity_data['documenti'])} documenti per {nome_ente}")
         
         return entity_data
@@ -325,15 +496,17 @@ def compare_documents(old_data, new_data, nome_ente):
     old_docs = old_data.get("documenti", [])
     new_docs = new_data.get("documenti", [])
     
-    # Crea dizionari per il confronto rapido
-    old_docs_dict = {f"{doc['tipo_documento']}_{doc['codice_pratica']}_{doc['anno']}": doc for doc in old_docs}
+    # Caso più comune: nessuna variazione rispetto all'ultimo controllo
+    if old_docs == new_docs:
+        return changes
+    
+    # Insieme delle chiavi già note: serve solo il test di appartenenza
+    old_keys = {(doc['tipo_documento'], doc['codice_pratica'], doc['anno']) for doc in old_docs}
     
     # Cerca documenti nuovi
     for doc in new_docs:
-        doc_key = f"{doc['tipo_documento']}_{doc['codice_pratica']}_{doc['anno']}"
-        
         # Se questo documento non esisteva prima, è nuovo
-        if doc_key not in old_docs_dict:
+        if (doc['tipo_documento'], doc['codice_pratica'], doc['anno']) not in old_keys:
             is_bilancio = "BILANCIO" in doc["tipo_documento"].upper()
             year = doc["anno"]
             
@@ -373,34 +546,29 @@ def send_notification(changes):
         logger.warning("Nessun indirizzo email configurato per le notifiche")
         return
     
-    # Raggruppa le modifiche per ente
-    changes_by_entity = {}
-    bilanci_2024 = {}
-    altri_bilanci = {}
+    # Raggruppa le modifiche per ente in un solo passaggio
+    changes_by_entity = defaultdict(list)
+    bilanci_2024 = defaultdict(list)
+    altri_bilanci = defaultdict(list)
     
     for change in changes:
         entity_key = f"{change['nome']} ({change['codice_fiscale']})"
-        if entity_key not in changes_by_entity:
-            changes_by_entity[entity_key] = []
-        
         changes_by_entity[entity_key].append(change)
         
         # Identifica specificamente i bilanci 2024 e gli altri bilanci
-        if change['campo'] == "Nuovo bilancio 2024 pubblicato":
-            if entity_key not in bilanci_2024:
-                bilanci_2024[entity_key] = []
+        campo = change['campo']
+        if campo == "Nuovo bilancio 2024 pubblicato":
             bilanci_2024[entity_key].append(change['valore_nuovo'])
-        elif "Nuovo bilancio" in change['campo'] and "pubblicato" in change['campo']:
-            if entity_key not in altri_bilanci:
-                altri_bilanci[entity_key] = []
+        elif campo.startswith("Nuovo bilancio") and campo.endswith("pubblicato"):
             altri_bilanci[entity_key].append(change['valore_nuovo'])
     
     # Conta il numero di entità con modifiche e bilanci 2024
     num_entities = len(changes_by_entity)
     num_bilanci_2024 = sum(len(bilanci) for bilanci in bilanci_2024.values())
     
-    # Crea il messaggio email
-    today = datetime.now().strftime("%d/%m/%Y")
+    # Crea il messaggio email (un solo timestamp per oggetto e nome del file)
+    now = datetime.now()
+    today = now.strftime("%d/%m/%Y")
     
     # Personalizza l'oggetto in base al contenuto
     if num_bilanci_2024 > 0:
@@ -411,180 +579,69 @@ def send_notification(changes):
     else:
         subject = f"Aggiornamento RUNTS: Nuovi documenti disponibili ({today})"
     
-    # Prepara il contenuto dell'email
-    email_content = f"""
-    <html>
-    <head>
-        <style>
-            body {{ font-family: 'Segoe UI', Arial, sans-serif; line-height: 1.6; color: #333; margin: 0; padding: 0; background-color: #f9f9f9; }}
-            .container {{ max-width: 650px; margin: 20px auto; background-color: #fff; border-radius: 6px; box-shadow: 0 3px 10px rgba(0,0,0,0.1); overflow: hidden; }}
-            .header {{ background-color: #3a6ea5; padding: 25px 30px; color: white; }}
-            .header h1 {{ margin: 0 0 10px 0; font-size: 24px; font-weight: 500; }}
-            .content {{ padding: 30px; }}
-            .intro {{ margin-bottom: 30px; }}
-            .summary {{ background-color: #f5f8fa; padding: 20px; margin: 0 0 30px 0; border-radius: 6px; border-left: 4px solid #3a6ea5; }}
-            h2 {{ font-size: 20px; margin: 0 0 15px 0; color: #2c3e50; font-weight: 500; }}
-            .entity {{ margin: 35px 0; }}
-            .entity-header {{ margin-bottom: 15px; }}
-            .entity-header h3 {{ font-size: 18px; margin: 0 0 5px 0; color: #2c3e50; }}
-            .entity-header p {{ margin: 0; color: #7f8c8d; font-size: 14px; }}
-            .highlight {{ background-color: #e8f4f8; padding: 15px; margin: 15px 0; border-radius: 6px; border-left: 4px solid #2980b9; }}
-            .highlight-urgent {{ background-color: #fff8e8; padding: 15px; margin: 15px 0; border-radius: 6px; border-left: 4px solid #e67e22; }}
-            .highlight h4, .highlight-urgent h4 {{ margin: 0 0 10px 0; font-size: 16px; }}
-            .highlight h4 {{ color: #2980b9; }}
-            .highlight-urgent h4 {{ color: #e67e22; }}
-            .highlight ul, .highlight-urgent ul {{ margin: 10px 0; padding-left: 25px; }}
-            table {{ border-collapse: collapse; width: 100%; margin: 15px 0; border-radius: 6px; overflow: hidden; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }}
-            th {{ background-color: #f2f2f2; text-align: left; padding: 12px 15px; font-size: 15px; color: #444; font-weight: 500; }}
-            td {{ padding: 10px 15px; border-top: 1px solid #eee; font-size: 14px; }}
-            tr:nth-child(even) {{ background-color: #f9f9f9; }}
-            tr:hover {{ background-color: #f5f5f5; }}
-            .bilancio-2024 {{ background-color: #fff8e8; font-weight: bold; }}
-            .footer {{ padding: 20px 30px; background-color: #f5f8fa; font-size: 14px; color: #7f8c8d; text-align: center; border-top: 1px solid #eee; }}
-            .button {{ display: inline-block; background-color: #3a6ea5; color: white; padding: 10px 20px; text-decoration: none; border-radius: 4px; margin-top: 10px; }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>Monitoraggio RUNTS: {"BILANCI 2024 PUBBLICATI" if num_bilanci_2024 > 0 else "Nuovi documenti disponibili"}</h1>
-                <div style="color: #e5e5e5; font-size: 14px;">{today}</div>
-            </div>
-            <div class="content">
-                <div class="intro">
-                    <p>Gentile utente,</p>
-    """
-    
-    # Personalizza l'introduzione in base alla presenza di bilanci 2024
-    if num_bilanci_2024 > 0:
-        email_content += f"""
-                    <p>ti avvisiamo che <strong>sono stati pubblicati {num_bilanci_2024} bilanci 2024</strong> sul Registro Unico Nazionale del Terzo Settore per gli enti che stai monitorando.</p>
-                    <p>Ti suggeriamo di prendere visione di questi bilanci il prima possibile.</p>
-        """
-    else:
-        email_content += """
-                    <p>durante l'ultimo controllo del Registro Unico Nazionale del Terzo Settore, abbiamo rilevato nuovi documenti pubblicati per alcuni degli enti che stai monitorando.</p>
-        """
-    
-    email_content += """
-                </div>
-                
-                <div class="summary">
-                    <h2>Riepilogo delle novità</h2>
-    """
-    
-    # Prima di tutto, evidenzia i bilanci 2024 se presenti
-    if bilanci_2024:
-        email_content += """
-            <div class="highlight-urgent">
-                <h4>🚨 BILANCI 2024 PUBBLICATI</h4>
-                <ul>
-        """
-        for entity, docs in bilanci_2024.items():
-            for doc in docs:
-                email_content += f"<li><strong>{entity}</strong>: {doc}</li>"
-        email_content += """
-                </ul>
-                <p style="margin-top: 15px; font-size: 13px; color: #666;"><strong>IMPORTANTE:</strong> Ti invitiamo a consultare al più presto questi bilanci recenti.</p>
-            </div>
-        """
-    
-    # Poi, mostra gli altri bilanci se presenti
-    if altri_bilanci:
-        email_content += """
-            <div class="highlight">
-                <h4>📊 Altri bilanci pubblicati</h4>
-                <ul>
-        """
-        for entity, docs in altri_bilanci.items():
-            for doc in docs:
-                email_content += f"<li><strong>{entity}</strong>: {doc}</li>"
-        email_content += """
-                </ul>
-            </div>
-        """
-    
-    email_content += "</div>"  # Fine div summary
-    
-    # Dettagli per ogni ente
+    # Prepara le righe di ogni ente, con i documenti ordinati per priorità
+    entities = []
     for entity_name, entity_changes in changes_by_entity.items():
-        email_content += f"""
-        <div class="entity">
-            <div class="entity-header">
-                <h3>{entity_name}</h3>
-                <p>{len(entity_changes)} nuovi documenti disponibili</p>
-            </div>
-        """
-        
-        # Tabella con tutti i nuovi documenti
-        email_content += """
-            <table>
-                <tr>
-                    <th style="width: 40%;">Documento</th>
-                    <th style="width: 60%;">Dettagli</th>
-                </tr>
-        """
-        
-        # Ordina i documenti per priorità
+        documenti = []
         for change in sorted(entity_changes, key=lambda x: 0 if "bilancio 2024" in x['campo'].lower() else (1 if "bilancio" in x['campo'].lower() else 2)):
-            css_class = ""
+            urgente = False
             prefix = "📄 "
             
             if "bilancio 2024" in change['campo'].lower():
-                css_class = "class='bilancio-2024'"
+                urgente = True
                 prefix = "🚨 "
             elif "bilancio" in change['campo'].lower():
                 prefix = "📊 "
             
-            email_content += f"""
-                <tr {css_class}>
-                    <td>{prefix}{change['campo'].replace("Nuovo ", "").replace(" pubblicato", "")}</td>
-                    <td>{change['valore_nuovo']}</td>
-                </tr>
-            """
-        
-        email_content += """
-            </table>
-        </div>
-        """
+            documenti.append({
+                "urgente": urgente,
+                "prefisso": prefix,
+                "tipo": change['campo'].replace("Nuovo ", "").replace(" pubblicato", ""),
+                "dettagli": change['valore_nuovo']
+            })
+        entities.append({"nome": entity_name, "documenti": documenti})
     
-    # Chiusura email
-    email_content += """
-                <div style="margin-top: 40px;">
-                    <p>I documenti sono disponibili per la consultazione sul portale RUNTS. Puoi accedervi direttamente cercando l'ente di interesse sul <a href="https://servizi.lavoro.gov.it/runts/it-it/Ricerca-enti">sito ufficiale del Registro</a>.</p>
-                    <p>Ti ricordiamo che questo monitoraggio è configurato per controllare regolarmente le variazioni documentali degli enti selezionati.</p>
-                    <p>Cordiali saluti,<br>
-                    Il sistema di monitoraggio RUNTS</p>
-                </div>
-            </div>
-            <div class="footer">
-                <p>Questa comunicazione è stata generata automaticamente dal sistema di monitoraggio RUNTS. Si prega di non rispondere a questa email.</p>
-                <p>Se desideri modificare la configurazione del monitoraggio o aggiungere nuovi enti da controllare, puoi farlo aggiornando il file di configurazione nel repository.</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
+    # Genera il contenuto dell'email dal template (compilato una volta e poi riusato)
+    email_content = TEMPLATE_ENV.get_template(NOTIFICATION_TEMPLATE).render(
+        today=today,
+        num_bilanci_2024=num_bilanci_2024,
+        bilanci_2024=bilanci_2024,
+        altri_bilanci=altri_bilanci,
+        entities=entities
+    )
     
     # Usa GitHub Actions per creare un'issue e inviare l'email
-    notification_file = f"{DATA_DIR}/notification_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-    with open(notification_file, 'w') as f:
-        json.dump({
-            "email": recipient_email,
-            "subject": subject,
-            "content": email_content,
-            "changes": changes
-        }, f, indent=2)
+    # (file temporaneo letto e cancellato dal workflow: JSON compatto, senza indentazione)
+    notification_file = f"{DATA_DIR}/notification_{now.strftime('%Y%m%d_%H%M%S')}.json"
+    write_json_atomic(notification_file, {
+        "email": recipient_email,
+        "subject": subject,
+        "content": email_content,
+        "changes": changes
+    })
     
     logger.info(f"Notifica salvata in {notification_file} per l'elaborazione da parte di GitHub Actions")
 
-async def process_entity(page, ente, history, all_changes):
-    """Processa un singolo ente, concentrandosi solo sui documenti"""
+async def process_entity(browser, ente, history, semaphore):
+    """Processa un singolo ente in un contesto browser dedicato, concentrandosi solo sui documenti"""
     codice_fiscale = ente["numero_repertorio"]
     nome = ente["nome"]
+    changes = []
     
-    # Estrai solo i documenti (ottimizzato)
-    current_data = await extract_entity_documents(page, codice_fiscale, nome)
+    # Limita il numero di contesti aperti contemporaneamente
+    async with semaphore:
+        context = await browser.new_context(
+            viewport={'width': 1920, 'height': 1080},
+            user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.212 Safari/537.36'
+        )
+        context.set_default_navigation_timeout(15000)
+        try:
+            await context.route("**/*", block_heavy_resources)
+            page = await context.new_page()
+            # Estrai solo i documenti (ottimizzato)
+            current_data = await extract_entity_documents(page, codice_fiscale, nome)
+        finally:
+            await context.close()
     
     # Verifica se abbiamo già dati storici per questo ente
     if codice_fiscale in history:
@@ -593,16 +650,14 @@ async def process_entity(page, ente, history, all_changes):
         # Confronta SOLO i documenti
         changes = compare_documents(old_data, current_data, nome)
         if changes:
-            all_changes.extend(changes)
             logger.info(f"Rilevati {len(changes)} nuovi documenti per l'ente {nome}")
     else:
         logger.info(f"Prima rilevazione per l'ente {nome}")
     
-    # Aggiorna lo storico
+    # Aggiorna lo storico (ogni ente scrive solo la propria chiave)
     history[codice_fiscale] = current_data
     
-    # Breve pausa tra un ente e l'altro
-    await asyncio.sleep(2)
+    return changes
 
 async def check_for_new_documents():
     """Controlla se ci sono nuovi documenti per gli enti monitorati"""
@@ -610,24 +665,22 @@ async def check_for_new_documents():
     history = load_history()
     all_changes = []
     
-    async with async_playwright() as playwright:
-        # Usa un browser Chromium con impostazioni più permissive
-        browser = await playwright.chromium.launch(
-            headless=True,
-            args=['--disable-web-security', '--no-sandbox', '--disable-features=site-per-process']
-        )
-        context = await browser.new_context(
-            viewport={'width': 1920, 'height': 1080},
-            user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.212 Safari/537.36'
-        )
-        page = await context.new_page()
-        
-        try:
-            for ente in config["enti"]:
-                await process_entity(page, ente, history, all_changes)
-        
-        finally:
-            await browser.close()
+    # Il browser resta attivo tra un controllo e l'altro: ogni ente usa un contesto nuovo
+    browser = await get_browser()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ENTI)
+    
+    # Elabora gli enti in parallelo, ognuno nel proprio contesto
+    results = await asyncio.gather(
+        *(process_entity(browser, ente, history, semaphore) for ente in config["enti"]),
+        return_exceptions=True
+    )
+    
+    # Unisci le modifiche mantenendo l'ordine degli enti in configurazione
+    for ente, result in zip(config["enti"], results):
+        if isinstance(result, Exception):
+            logger.error(f"Errore durante l'elaborazione dell'ente {ente['nome']}: {result}")
+            continue
+        all_changes.extend(result)
         
     # Salva lo storico aggiornato
     save_history(history)
@@ -641,10 +694,17 @@ async def check_for_new_documents():
     
     return all_changes
 
+async def run_monitor():
+    """Esegue un controllo completo e chiude il browser condiviso al termine"""
+    try:
+        return await check_for_new_documents()
+    finally:
+        await close_browser()
+
 # Funzione principale
 def main():
     logger.info("Avvio del monitoraggio documenti RUNTS")
-    asyncio.run(check_for_new_documents())
+    asyncio.run(run_monitor())
     logger.info("Monitoraggio completato")
 
 if __name__ == "__main__":